@@ -2,7 +2,7 @@
 """
 Script which downloads & formats an online text (article, blogpost) for printing / easier reading.
 
-Uses pandoc, BeautifulSoup and exiftool. Can produce most formats that pandoc can output to (PDF, HTML, DOCX, EPUB, ODT,
+Uses pandoc, lxml and exiftool. Can produce most formats that pandoc can output to (PDF, HTML, DOCX, EPUB, ODT,
 RTF, etc.), MHT (custom generator) or ZIP archive of HTML + images.
 
 Sample usage:
@@ -10,7 +10,7 @@ getdoc.py http://some.website.com/some-awesome-article-or-blogpost -o pdf
 
 Installing dependencies (can be automated for Ubuntu - run `getdoc.py --setup`):
 - install Python 3
-- pip3 install beautifulsoup4 lxml
+- pip3 install lxml urllib3
 - install xelatex and exiftool
     - Ubuntu Linux: `sudo apt install texlive-xetex libimage-exiftool-perl`
     - Windows:
@@ -23,40 +23,88 @@ Version: 0.1.1 (2018.09.19)
 
 import argparse
 import base64
-import email
+import concurrent.futures
+import email.generator
+import email.message
+import functools
 import glob
 import gzip
 import hashlib
+import io
 import mimetypes
 import os
 import quopri
 import re
+import shutil
+import struct
 import subprocess
 import sys
 import tempfile
 import time
 from urllib import request
+from urllib.error import HTTPError
 from urllib.parse import urljoin, urlparse
 import zipfile
 
 try:
-    from bs4 import BeautifulSoup, NavigableString, Comment
+    import lxml.html
+    from lxml import etree
 except ImportError:
-    print('[!] Can\'t import BeautifulSoup; run with --setup to try to automatically install it on Ubuntu.')
-    bs4 = None
+    print('[!] Can\'t import lxml; run with --setup to try to automatically install it on Ubuntu.')
+    etree = None
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None      # optional, falls back to urllib (no connection reuse)
 
 
 USER_AGENT = 'Mozilla/5.0 (compatible; NoOS 1.0)'
+DL_CHUNK_SIZE = 64 * 1024
 REMOVE_TAGS = ('frame', 'iframe', 'embed', 'object', 'script', 'link', 'meta', 'style', 'aside', 'footer', 'form',
         'nav')
+## site-specific junk: (tag, attribute, values); `class` values are matched against each class name
+REMOVE_ATTRS = (
+    ## wordpress
+    ('div', 'class', ('wpcnt', 'sharedaddy', 'share-subscribe')),
+    ('div', 'id', ('respondcon',)),
+    ## wiki*pedia
+    ('*', 'class', ('mw-jump', 'mw-editsection', 'navbar', 'noprint', 'navigation', 'share-button', 'bottom-notice')),
+    ## wikia
+    ('div', 'id', ('WikiaArticleMsg',)),
+    ('span', 'class', ('editsection',)),
+    ## gist
+    ('div', 'class', ('gist-file-navigation', 'js-header-wrapper', 'js-discussion')),
+    ('a', 'class', ('float-right',)),
+    ## wikihow
+    ('p', 'id', ('method_toc',)),
+    ('div', 'class', ('relatedwikihows', 's-help-wrap', 'qa_answer_footer', 'qa_question_tab', 'qa_answerer_info')),
+    ('div', 'id', ('qa_ask_heading', 'sp_icon_hover', 'uci_section', 'article_info_section')),
+    ## misc
+    ('div', 'id', ('comment_form',)),     # core sec blog
+    )
+IMG_MAGIC = {b'\x89PNG':'png', b'GIF8':'gif', b'\xFF\xD8\xFF':'jpg', b'RIFF':'webp', b'<svg':'svg'}
+IMG_EXTS = ('jpg', 'jpeg', 'png', 'gif', 'webp', 'svg')
+## outputs which can embed all of IMG_EXTS; the others (converted by pandoc, e.g. PDF through xelatex) only take these
+## (plus SVG if pandoc can convert it with rsvg-convert)
+WEB_OUTPUTS = ('htm', 'html', 'zip', 'mht', 'epub')
+PRINT_IMG_EXTS = ('jpg', 'jpeg', 'png', 'gif')
+STORED_EXTS = ('jpg', 'jpeg', 'png', 'gif', 'webp')
+EXT2MIME = {e:mimetypes.guess_type('x.' + e)[0] for e in ('html',) + IMG_EXTS}
+## output extension => pandoc output format (PDF is produced by xelatex from LaTeX)
+PANDOC_FORMATS = {'pdf':'latex', 'epub':'epub', 'rtf':'rtf', 'docx':'docx', 'odt':'odt', 'md':'markdown'}
 OPTIONS = {
     'cache_dir':'.dldcache',
+    'dl_threads':8,
     }
+HTML_PARSER = lxml.html.HTMLParser(remove_blank_text=True) if etree else None     # drops whitespace between tags
+HTML_PARSER_UTF8 = lxml.html.HTMLParser(remove_blank_text=True, encoding='utf-8') if etree else None
+HTTP = None     # urllib3 PoolManager, created once the options are known (sized to the download threads)
 
 RX = {
-    'sp-b-tags':(b'(>)[ \r\n\t]+(</?[a-z])',),
     'clean-fn':('[^a-z0-9 ,_.-]+', re.I),
     'merge-blanks':('[ \t\r\n]+', re.I),
+    'content-id':('^((body)?contents?|gist-pjax-container)$',),
+    'so-tabs-id':('^(tabs|comments-link-.+)$',),
     }
 for k in RX:
     RX[k] = re.compile(*RX[k])
@@ -64,34 +112,105 @@ for k in RX:
 APPID = 'getdoc-by-vtopan'
 
 
+def fix_jfif_dpi(data):
+    """
+    Sets the resolution in the JFIF header of a JPEG image to 72 DPI if it's not given in DPI (or is bogus).
+
+    :param data: JPEG image data
+    :return: the (patched) image data or None if the image has no JFIF header
+    """
+    if len(data) < 18 or data[:4] != b'\xFF\xD8\xFF\xE0' or data[6:11] != b'JFIF\0':
+        return None
+    units, xdens, ydens = struct.unpack_from('>BHH', data, 13)
+    if units == 1 and xdens > 1 and ydens > 1:
+        return data
+    data = bytearray(data)
+    struct.pack_into('>BHH', data, 13, 1, 72, 72)
+    return bytes(data)
+
+
+def xpath_str(s):
+    """
+    Quotes a string as an XPath literal (XPath 1.0 has no escapes, strings containing both quote types are concat()-ed).
+    """
+    if "'" not in s:
+        return "'%s'" % s
+    if '"' not in s:
+        return '"%s"' % s
+    return 'concat(%s)' % ', "\'", '.join("'%s'" % e for e in s.split("'"))
+
+
+def attr_pred(attr, val):
+    """
+    Generates the XPath predicate matching an attribute value (for `class`, one of the class names).
+    """
+    if attr == 'class':
+        return "contains(concat(' ', normalize-space(@class), ' '), %s)" % xpath_str(' %s ' % val)
+    return '@%s=%s' % (attr, xpath_str(val))
+
+
+## everything which is always removed (REMOVE_TAGS, REMOVE_ATTRS, sidebars and comments); a single predicate on the
+## descendant axis walks the tree once (an XPath union of paths would walk it once per path)
+REMOVE_XPATH = etree.XPath('.//node()[%s]' % ' or '.join(['self::%s' % t for t in REMOVE_TAGS]
+        + ['self::%s and (%s)' % (tag, ' or '.join(attr_pred(attr, v) for v in vals)) for tag, attr, vals in REMOVE_ATTRS]
+        + ["contains(@id, 'sidebar')", 'self::comment()'])) if etree else None
+
+
 def cache_path(s):
     """
     Generates the path where a URL would be cached.
     """
-    h = hashlib.md5(s.encode('utf8')).hexdigest()
+    h = hashlib.blake2b(s.encode('utf8'), digest_size=16).hexdigest()
     if not os.path.isdir(OPTIONS['cache_dir']):
-        os.makedirs(OPTIONS['cache_dir'])
+        os.makedirs(OPTIONS['cache_dir'], exist_ok=True)
     return '%s/%s' % (OPTIONS['cache_dir'], h)
 
 
-def download(url, user_agent=USER_AGENT, referer=None, cache=True):
+def download(url, user_agent=USER_AGENT, referer=None, cache=True, verbose=True):
     """
     Download from a URL.
     """
     if cache:
         p = cache_path(url)
         if os.path.isfile(p):
-            return 200, None, open(p, 'rb').read()
-    print('[#] URL: %s' % url)
+            with open(p, 'rb') as f:
+                return 200, None, f.read()
+    if verbose:
+        print('[#] URL: %s' % url)
     headers = {'User-Agent':user_agent}
     if referer:
         headers['Referer'] = referer
-    req = request.Request(url, headers=headers)
-    r = request.urlopen(req)
-    data = r.read()
-    if cache:
-        open(p, 'wb').write(data)
-    return r.code, r.headers, data
+    if HTTP and url.startswith(('http://', 'https://')):
+        ## pooled connections are reused across calls (all the images usually come from the same host)
+        r = HTTP.request('GET', url, headers=headers, preload_content=False)
+        if r.status >= 400:
+            r.release_conn()
+            raise HTTPError(url, r.status, r.reason, r.headers, None)
+        code, chunks, done = r.status, r.stream(DL_CHUNK_SIZE), r.release_conn
+    else:
+        r = request.urlopen(request.Request(url, headers=headers))
+        code, chunks, done = r.code, iter(functools.partial(r.read, DL_CHUNK_SIZE), b''), r.close
+    data = io.BytesIO()
+    try:
+        if cache:
+            ## the body goes to the cache file as it arrives, through a temp file so a concurrent / interrupted download
+            ## never leaves a partial cache entry
+            fd, tmpfn = tempfile.mkstemp(dir=OPTIONS['cache_dir'])
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                        data.write(chunk)
+            except BaseException:
+                os.unlink(tmpfn)
+                raise
+            os.replace(tmpfn, p)
+        else:
+            for chunk in chunks:
+                data.write(chunk)
+    finally:
+        done()
+    return code, r.headers, data.getvalue()
 
 
 def clean_fn(s):
@@ -101,22 +220,43 @@ def clean_fn(s):
     return RX['merge-blanks'].sub(' ', RX['clean-fn'].sub('', s))
 
 
-def rm_by_attr(bs, tag=None, attr=None, val=None):
+@functools.lru_cache(maxsize=None)
+def attr_xpath(tag, attr, vals):
+    """
+    Compiles (once) the XPath selecting the `tag` nodes whose `attr` attribute matches any of `vals` (see `find_by_attr()`).
     """
-    Remove all nodes matching the tag/attribute/values given.
+    preds = [attr_pred(attr, v) if isinstance(v, str)
+            else "re:test(@%s, %s, '%s')" % (attr, xpath_str(v.pattern), 'i' if v.flags & re.I else '') for v in vals]
+    return etree.XPath('.//%s[%s]' % (tag, ' or '.join(preds)), namespaces={'re':'http://exslt.org/regular-expressions'})
+
 
-    :param bs: BeautifulSoup object
-    :param tag: tag name or list of names (optional)
+def find_by_attr(root, tag=None, attr=None, val=None):
+    """
+    Find all nodes matching the tag/attribute/values given (in a single pass, regardless of the number of values).
+
+    :param root: lxml element to search in
+    :param tag: tag name (optional)
     :param attr: attribute name (e.g. 'class', 'id', 'href', ...)
-    :param val: attribute value or list of values (the value can be a string or a regex)
+    :param val: attribute value or list of values (the value can be a string or a regex, except for `class`, whose
+        values are matched against each class name)
+    :return: list of nodes
     """
     if type(val) not in (list, tuple):
         val = [val]
-    for v in val:
-        # print('[*] Looking for %s/%s/%s' % (tag, attr, v))
-        nodes = bs.find_all(tag, attrs={attr:v})
-        for n in nodes:
-            n.extract()
+    return attr_xpath(tag or '*', attr, tuple(val))(root)
+
+
+def rm_by_attr(root, tag=None, attr=None, val=None):
+    """
+    Remove all nodes matching the tag/attribute/values given (see `find_by_attr()`).
+
+    :param root: lxml element
+    :param tag: tag name (optional)
+    :param attr: attribute name (e.g. 'class', 'id', 'href', ...)
+    :param val: attribute value or list of values
+    """
+    for n in find_by_attr(root, tag, attr, val):
+        n.drop_tree()
 
 
 def getdoc(url, filename=None, workdir='.'):
@@ -128,193 +268,196 @@ def getdoc(url, filename=None, workdir='.'):
     tags = set()
     fn = os.path.join(workdir, 'out.html')
 
-    data = RX['sp-b-tags'].sub(rb'\1\2', data)
-    bs = BeautifulSoup(data, 'lxml')
-    obs = BeautifulSoup('<!DOCTYPE html><html><head/><body/></html>', 'lxml')
-    cdiv = bs.find('article') \
-            or bs.find('div', {'class':re.compile('^(post|(inner-|main_)content)$')}) \
-            or bs.find('div', {'class':re.compile('^content$')}) \
-            or bs.find('div', {'id':re.compile('^((body)?contents?|gist-pjax-container)$')})   # keep this generic one last
-    if cdiv:
-        print('[*] Found content entry (%s/#%s/.%s)...' % (cdiv.name, cdiv.get('id'), cdiv.get('class')))
-        cdiv.name = 'body'
-        obs.head.replace_with(bs.head)
-        obs.body.replace_with(cdiv)
-    else:
-        obs = bs
+    try:
+        data.decode('utf8')
+        parser = HTML_PARSER_UTF8       # libxml2 assumes latin-1 if the page doesn't declare its charset
+    except UnicodeDecodeError:
+        parser = HTML_PARSER
+    root = lxml.html.document_fromstring(data, parser=parser)
+    cdiv = (root.xpath('.//article') or find_by_attr(root, 'div', 'class', ('post', 'inner-content', 'main_content'))
+            or find_by_attr(root, 'div', 'class', 'content')
+            or find_by_attr(root, 'div', 'id', RX['content-id'])   # keep this generic one last
+            or [None])[0]
+    if cdiv is not None:
+        print('[*] Found content entry (%s/#%s/.%s)...' % (cdiv.tag, cdiv.get('id'), cdiv.get('class')))
+        cdiv.tag = 'body'
+        cdiv.tail = None
+        root.replace(root.body, cdiv)
     ## get meta before it's gone
     meta = {
-        'og-sitename':(obs.find_all('meta', attrs={'name':'og:site_name'}) or [{}])[0].get('content'),
-        'canonical-url':(obs.find_all('link', attrs={'rel':'canonical'}) or [{}])[0].get('href'),
+        'og-sitename':(root.xpath('.//meta[@name="og:site_name"]/@content') or [None])[0],
+        'canonical-url':(root.xpath('.//link[@rel="canonical"]/@href') or [None])[0],
         }
-    ## remove tags
-    for tag in obs(REMOVE_TAGS):
-        tag.decompose()
+    ## remove tags, site-specific junk and comments
+    for tag in REMOVE_XPATH(root):
+        tag.drop_tree()
+    body = root.body
     ## stackoverflow votes
-    if obs.find('td', attrs={'class':'votecell'}):
+    if find_by_attr(root, 'td', 'class', 'votecell'):
         print('[*] StackOverflow-like site')
         tags.add('stackoverflow')
-        for tag in obs.find_all('td', attrs={'class':'vt'}):
-            tag.extract()
-        rm_by_attr(obs, 'table', 'class', 'fw')
-        rm_by_attr(obs, 'td', 'class', ['comment-score'])
-        rm_by_attr(obs, 'div', 'class', ['post-taglist', 'answers-subheader'])
-        rm_by_attr(obs, 'div', 'id', re.compile('^(tabs|comments-link-.+)$'))
-        rm_by_attr(obs, 'a', 'class', 'btn-outlined')
-        rm_by_attr(obs, 'a', 'title', 'feed of this question and its answers')
+        rm_by_attr(root, 'td', 'class', 'vt')
+        rm_by_attr(root, 'table', 'class', 'fw')
+        rm_by_attr(root, 'td', 'class', ['comment-score'])
+        rm_by_attr(root, 'div', 'class', ['post-taglist', 'answers-subheader'])
+        rm_by_attr(root, 'div', 'id', RX['so-tabs-id'])
+        rm_by_attr(root, 'a', 'class', 'btn-outlined')
+        rm_by_attr(root, 'a', 'title', 'feed of this question and its answers')
         ansid = 0
-        ttitle = obs.body.h1
-        votecells = obs.find_all('td', attrs={'class':'votecell'})
-        obs.body.clear()
-        obs.body.append(ttitle)
+        ttitle = next(body.iter('h1'), None)
+        votecells = find_by_attr(root, 'td', 'class', 'votecell')
+        body.text = None
+        for e in list(body):
+            body.remove(e)
+        if ttitle is not None:
+            ttitle.tail = None
+            body.append(ttitle)
         for vc in votecells:
-            vt = vc.find_parent('table')
+            vt = next(vc.iterancestors('table'))
             comment = 0
-            for i, td in enumerate(vt.find_all('td', attrs={'class':'votecell'})):
-                td = td.parent
-                for e in td.find_all(['h1', 'h2', 'h3', 'h4', 'h5']):
-                    e.name = 'h%s' % (int(e.name[1]) + 2)
+            for i, td in enumerate(find_by_attr(vt, 'td', 'class', 'votecell')):
+                td = td.getparent()
+                for e in list(td.iter('h1', 'h2', 'h3', 'h4', 'h5')):
+                    e.tag = 'h%s' % (int(e.tag[1]) + 2)
                 h = None
-                ts = td.find_all('div', attrs={'class':'post-text'})
+                ts = find_by_attr(td, 'div', 'class', 'post-text')
                 if not ts:
-                    ts = td.find_all('div', attrs={'class':'comment-body'})
+                    ts = find_by_attr(td, 'div', 'class', 'comment-body')
                     if not ts:
                         continue
                     h = ('h4', 'Comments')
                     comment = 1
-                elif vt.find(attrs={'class':'answercell'}):
+                elif find_by_attr(vt, None, 'class', 'answercell'):
                     ansid += 1
                     h = ('h2', 'Answer %s' % ansid)
                 if h:
-                    ht = obs.new_tag(h[0])
-                    ht.string = h[1]
-                    obs.body.append(ht)
+                    etree.SubElement(body, h[0]).text = h[1]
                 for e in ts:
-                    obs.body.append(e)
+                    e.tail = None
+                    body.append(e)
                     if not comment:
-                        e.unwrap()
+                        e.drop_tag()
                     else:
-                        e.name = 'p'
-    title = obs.head.title.string.strip()
-    # open('out-pre.html', 'w').write(obs.prettify(formatter='html'))
+                        e.tag = 'p'
+    title = (root.findtext('head/title') or '').strip()
+    # open('out-pre.html', 'wb').write(lxml.html.tostring(root))
     ## remove irrelevant items
     if meta['og-sitename'] == 'DigitalOcean':
         ## digitalocean
-        rm_by_attr(obs, 'div', 'class', ['postable-info-bar-container', 'info-cta'])
-        rm_by_attr(obs, 'h1', 'class', ['content-title'])
-        rm_by_attr(obs, 'img', 'class', ['tutorial-image', 'tutorial-image-mobile'])
-        rm_by_attr(obs, 'button', 'class', ['new-upvote-button'])
-    ## wordpress
-    rm_by_attr(obs, 'div', 'class', ('wpcnt', 'sharedaddy', 'share-subscribe'))
-    rm_by_attr(obs, 'div', 'id', 'respondcon')
-    ## wiki*pedia
-    for tag in obs.find_all(attrs={'class':re.compile(
-            '^(mw-(jump|editsection)|navbar|noprint|navigation|share-button|bottom-notice)$')}):
-        # print('DEL/cls: %s' % str(tag)[:50])
-        tag.decompose()
-    ## wikia
-    rm_by_attr(obs, 'div', 'id', 'WikiaArticleMsg')
-    rm_by_attr(obs, 'span', 'class', 'editsection')
-    ## gist
-    rm_by_attr(obs, 'div', 'class', ['gist-file-navigation', 'js-header-wrapper', 'js-discussion'])
-    rm_by_attr(obs, 'a', 'class', 'float-right')
-    ## wikihow
-    rm_by_attr(obs, 'p', 'id', 'method_toc')
-    rm_by_attr(obs, 'div', 'class', ['relatedwikihows', 's-help-wrap', 'qa_answer_footer', 'qa_question_tab', 'qa_answerer_info'])
-    rm_by_attr(obs, 'div', 'id', ['qa_ask_heading', 'sp_icon_hover', 'uci_section', 'article_info_section'])
-    ## misc
-    rm_by_attr(obs, 'div', 'id', 'comment_form')     # core sec blog
-    for tag in obs.find_all(attrs={'id':re.compile('sidebar')}):
-        tag.decompose()
-    ## remove comments and empty tags
-    for tag in obs.find_all(text=lambda text:isinstance(text, Comment)):
-        tag.extract()
-    while 1:
-        changed = 0
-        for tag in obs.find_all():
-            if ((not tag.contents) or (len(tag.contents) == 1 and type(tag.contents[0]) == NavigableString and
-                        not tag.contents[0].string.strip())) and tag.name not in ('img',):
-                tag.extract()
-                changed = 1
-        if not changed:
-            break
-    for tag in obs():
-        if tag.name not in ('img',) and not tag.contents:
-            tag.decompose()
+        rm_by_attr(root, 'div', 'class', ['postable-info-bar-container', 'info-cta'])
+        rm_by_attr(root, 'h1', 'class', ['content-title'])
+        rm_by_attr(root, 'img', 'class', ['tutorial-image', 'tutorial-image-mobile'])
+        rm_by_attr(root, 'button', 'class', ['new-upvote-button'])
+    ## remove empty tags
+    # reversed document order visits all children before their parent, so emptiness propagates up in a single pass
+    for tag in reversed(list(root.iterdescendants(etree.Element))):
+        if tag.tag not in ('img',) and not len(tag) and not (tag.text or '').strip():
+            tag.drop_tree()
     ## remove div wrappers (wrapping a single other tag)
-    for tag in obs.find_all('div'):
-        if len(tag.contents) == 1 and tag.contents[0].name:
-            tag.unwrap()
+    for tag in list(root.iter('div')):
+        if len(tag) == 1 and not (tag.text or '').strip() and not (tag[0].tail or '').strip():
+            tag.drop_tag()
     ## fix a hrefs
-    for tag in obs.find_all('a'):
-        if tag.get('href') and '://' not in tag['href']:
-            tag['href'] = urljoin(url, tag['href'])
+    for tag in root.iter('a'):
+        href = tag.get('href')
+        if href and '://' not in href:
+            tag.set('href', urljoin(url, href))
     ## remove attributes
     if not OPTIONS['dbg_keepattrs']:
-        for tag in obs():
-            tag.attrs = {k:v for k, v in tag.attrs.items() if k in ('src', 'href', 'alt')}
+        for tag in root.iter(etree.Element):
+            for k in tag.attrib.keys():
+                if k not in ('src', 'href', 'alt'):
+                    del tag.attrib[k]
     if (not filename) or len(filename) < 5:
         ext = '.html' if not filename else ('.' + filename.strip('.'))
-        filename = clean_fn(obs.head.title.string) + ext
+        filename = clean_fn(title) + ext
         print('[*] Guessed filename: %s' % filename)
     ## retrieve images
-    tryfilecmd = 1
-    for i, t in enumerate(obs.find_all('img')):
-        if not t.get('src'):
-            t.extract()
+    outext = filename.lower().rsplit('.', 1)[-1]
+    if outext in WEB_OUTPUTS:
+        img_exts = IMG_EXTS
+    else:
+        img_exts = PRINT_IMG_EXTS + (('svg',) if shutil.which('rsvg-convert') else ())
+    imgs = []
+    for i, t in enumerate(list(root.iter('img'))):
+        src = t.get('src')
+        if not src:
+            t.drop_tree()
             continue
-        src = t['src']
         if '://' not in src:
             src = urljoin(url, src)
-        print('[-] Getting image [%s]...' % src.rsplit('/', 1)[-1])
-        imgdata = download(src, referer=url)[2]
-        ext = src.rsplit('.', 1)[-1].lower()
+        imgs.append((i, t, src))
+
+    def get_image(img):
+        ## one line in a single write per image, so the output of the download threads doesn't get interleaved
+        print('[-] Getting image [%s]...\n' % img[2].rsplit('/', 1)[-1], end='')
+        return download(img[2], referer=url, verbose=False)[2]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=OPTIONS['dl_threads']) as ex:
+        imgdatas = list(ex.map(get_image, imgs))
+    tryexiftool = 1
+    for (i, t, src), imgdata in zip(imgs, imgdatas):
         if imgdata.startswith(b'\x1F\x8B'):
             ## gzip-compresed data
             imgdata = gzip.decompress(imgdata)
-        if ext not in ('jpg', 'jpeg', 'png', 'gif'):
-            ## attempt to identify image format by header
-            if imgdata.startswith(b'\x89PNG'):
-                ext = 'png'
-            elif imgdata.startswith(b'GIF'):
-                ext = 'gif'
-            elif imgdata.startswith(b'\xFF\xD8\xFF'):
-                ext = 'jpg'
-            else:
-                print('[!] Unknown image format (%s): %s' % (src, imgdata[:16]))
-                t.extract()
-                continue
+        ## identify image format by header (JPEG only has a 3-byte signature), fall back to the URL extension
+        ext = IMG_MAGIC.get(imgdata[:4]) or IMG_MAGIC.get(imgdata[:3])
+        if ext == 'webp' and imgdata[8:12] != b'WEBP':
+            ext = 'riff'    # some other RIFF container (WAV, AVI, ...)
+        ext = ext or src.rsplit('.', 1)[-1].lower()
+        if ext not in IMG_EXTS:
+            print('[!] Unknown image format (%s): %s' % (src, imgdata[:16]))
+            t.drop_tree()
+            continue
+        if ext not in img_exts:
+            print('[!] Can\'t use %s images in %s output, dropping %s' % (ext.upper(), outext.upper(), src))
+            t.drop_tree()
+            continue
         imgfn = 'image%03d.%s' % (i, ext)
-        t['src'] = imgfn
+        t.set('src', imgfn)
         imgfull = os.path.join(workdir, imgfn)
-        open(imgfull, 'wb').write(imgdata)
-        if ext == 'jpg' and tryfilecmd:
+        runexiftool = 0
+        if ext in ('jpg', 'jpeg'):
+            fixed = fix_jfif_dpi(imgdata)
+            if fixed is not None:
+                imgdata = fixed
+            elif imgdata.startswith(b'\xFF\xD8\xFF'):
+                ## a JPEG without a JFIF header to patch, let exiftool add one
+                runexiftool = tryexiftool
+        with open(imgfull, 'wb') as f:
+            f.write(imgdata)
+        if runexiftool:
             try:
-                out = subprocess.check_output('file "%s"' % imgfull, shell=True)
-                if b'DPI' not in out:
-                    subprocess.call('exiftool -jfif:Xresolution=72 -jfif:Yresolution=72 -jfif:ResolutionUnit=inch %s'
-                        % imgfull, shell=True)
-                    os.remove('%s_original' % imgfull)
+                subprocess.check_call(['exiftool', '-q', '-overwrite_original', '-jfif:Xresolution=72',
+                        '-jfif:Yresolution=72', '-jfif:ResolutionUnit=inch', imgfull])
+            except OSError as e:
+                print(f'[!] WARNING: failed running exiftool: {e}')
+                tryexiftool = 0
             except subprocess.CalledProcessError as e:
-                print(f'[!] WARNING: failed running the file/exiftool commands: {e}')
-                tryfilecmd = 0
+                print(f'[!] WARNING: exiftool failed on {imgfn}: {e}')
     ### add source link to document
-    footer = BeautifulSoup('<p style="font-size: 80%"><i color="#888">[getdoc]</i>'
-            f'Retrieved @ {time.strftime("%d.%m.%Y")} from <a href="{url}">{urlparse(url).netloc}</a></p>', 'lxml')
-    obs.body.append(footer)
+    footer = lxml.html.fragment_fromstring('<p style="font-size: 80%"><i color="#888">[getdoc]</i>'
+            f'Retrieved @ {time.strftime("%d.%m.%Y")} from <a href="{url}">{urlparse(url).netloc}</a></p>')
+    root.body.append(footer)
     ### produce output file
     htmlfn = os.path.join(workdir, 'index.html')    # must be index.html for MHT!
-    rawtext = obs.prettify(formatter='html').encode('utf8')
+    ## the page's meta tags are gone, declare the charset the HTML is written in
+    if root.find('head') is None:
+        root.insert(0, root.makeelement('head', {}))
+    root.find('head').insert(0, root.makeelement('meta', {'charset':'utf-8'}))
+    rawtext = lxml.html.tostring(root, pretty_print=True, encoding='utf-8', method='html', doctype='<!DOCTYPE html>')
     open(htmlfn, 'wb').write(rawtext)
     ext = filename.lower().rsplit('.', 1)[-1]
     files = glob.glob('%s/*' % workdir)
     if ext in ('htm', 'html'):
-        open(filename, 'wb').write(open(htmlfn, 'rb').read())
+        with open(filename, 'wb') as f:
+            f.write(rawtext)
     elif ext == 'zip':
-        zf = zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED)
-        for f in files:
-            zf.writestr(os.path.basename(f), open(f, 'rb').read())
-        zf.close()
+        with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zf:
+            for f in files:
+                ## already compressed images gain nothing from deflate
+                ctype = zipfile.ZIP_STORED if f.rsplit('.', 1)[-1].lower() in STORED_EXTS else None
+                zf.write(f, arcname=os.path.basename(f), compress_type=ctype)
     elif ext == 'mht':
         ## MHT generation inspired by https://github.com/Modified/MHTifier/blob/master/mhtifier.py
         msg = email.message.Message()
@@ -325,15 +468,31 @@ def getdoc(url, filename=None, workdir='.'):
         msg.add_header('Content-Type', 'multipart/related', type='text/html')
         for f in sorted(files, key=lambda x:(0,0) if 'index.html' in x else (1, x)):
             part = email.message.Message()
-            mt = mimetypes.guess_type(f)[0]
-            data = open(f, 'rb').read()
+            mt = EXT2MIME.get(f.rsplit('.', 1)[-1])
+            if f.endswith('index.html'):
+                data = rawtext
+            else:
+                with open(f, 'rb') as fh:
+                    data = fh.read()
+            cte = 'base64'
             if mt and mt.startswith('text/'):
-                part['Content-Transfer-Encoding'] = 'quoted-printable'
+                cte = 'quoted-printable'
+                if b'\0' not in data and max(map(len, data.splitlines()), default=0) <= 998:
+                    ## within the RFC 5322 line length limit, ASCII / UTF-8 text doesn't need quoting
+                    if data.isascii():
+                        cte = '7bit'
+                    else:
+                        try:
+                            data.decode('utf8')
+                            cte = '8bit'
+                        except UnicodeDecodeError:
+                            pass
+            part['Content-Transfer-Encoding'] = cte
+            if cte == 'quoted-printable':
                 data = quopri.encodestring(data)
-            else:
-                part['Content-Transfer-Encoding'] = 'base64'
+            elif cte == 'base64':
                 data = base64.b64encode(data)
-            part.set_payload(data)
+            part.set_payload(data.decode('ascii', 'surrogateescape'))     # 8bit data is written back as is
             if f.endswith('index.html'):
                 part.add_header('Content-Type', 'text/html', charset='utf-8')
                 part['Content-Location'] = url
@@ -342,16 +501,20 @@ def getdoc(url, filename=None, workdir='.'):
                 if mt:
                     part['Content-Type'] = mt
             msg.attach(part)
-        open(filename, 'wb').write(msg.as_bytes())
-    elif ext in ('pdf', 'epub', 'rtf', 'docx', 'odt', 'md'):
-        xargs = []
+        with open(filename, 'wb') as fh:
+            ## streamed to the file, as_bytes() would build the whole document in memory first
+            email.generator.BytesGenerator(fh, mangle_from_=False).flatten(msg)
+    elif ext in PANDOC_FORMATS:
+        ## explicit input/output formats, so pandoc doesn't have to guess them from the file extensions
+        fmt_from, xargs = 'html', []
         if ext == 'pdf':
             xargs = ['--pdf-engine=xelatex', '-V', 'geometry:paperwidth=210mm,paperheight=297mm,margin=1.5cm']
         elif ext == 'md':
-            xargs = ['-f', 'html-native_divs-native_spans', '--columns=100']
+            fmt_from, xargs = 'html-native_divs-native_spans', ['--columns=100']
         fn = os.path.abspath(filename)
         print('[*] Generating %s with pandoc...' % ext)
-        subprocess.call(['pandoc', '-s', htmlfn, '-o', fn] + xargs, cwd=workdir)
+        subprocess.call(['pandoc', '-s', '--from=%s' % fmt_from, '--to=%s' % PANDOC_FORMATS[ext], htmlfn, '-o', fn]
+                + xargs, cwd=workdir)
     else:
         raise ValueError('[!] Invalid / unknown output format [%s]!' % ext)
     if os.path.isfile(filename):
@@ -366,14 +529,20 @@ argp.add_argument('-S', '--setup', help='Install required libs/packages on Ubunt
 argp.add_argument('-o', '--output', help='Output filename (extension controls format)', default='out.html')
 argp.add_argument('-dk', '--dbg-keepattrs', help='Keep tag attributes for debugging', action='store_true')
 argp.add_argument('-cd', '--cache-dir', help='Download cache dir', default=OPTIONS['cache_dir'])
+argp.add_argument('-dt', '--dl-threads', help='Number of parallel image downloads', type=int,
+        default=OPTIONS['dl_threads'])
 args = argp.parse_args()
+if args.dl_threads < 1:
+    argp.error('the number of download threads must be at least 1')
 OPTIONS.update(vars(args))
+if urllib3:
+    HTTP = urllib3.PoolManager(maxsize=OPTIONS['dl_threads'])
 
 if args.setup:
     print('[*] Installing xelatex (texlive-xetex) and exiftool (libimage-exiftool-perl)...')
     os.system('sudo apt install python3 texlive-xetex libimage-exiftool-perl')
-    print('[*] Installing the BeautifulSoup 4 and lxml Python packages...')
-    os.system('pip3 install --user beautifulsoup4 lxml')
+    print('[*] Installing the lxml and urllib3 Python packages...')
+    os.system('pip3 install --user lxml urllib3')
     sys.exit('[*] Installed all required packages/modules.')
 
 with tempfile.TemporaryDirectory() as tempd: